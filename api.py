@@ -3,9 +3,16 @@ import requests
 import pprint
 import configparser
 import json
+import os
 import re
+import secrets
+import signal
+import string
+import threading
 import time
 from bs4 import BeautifulSoup
+from htmlstream import iter_fragments
+from shard import Coordinator
 from pushover import Client
 from oauth2client import client, file, tools
 from googleapiclient.http import build_http
@@ -13,39 +20,88 @@ from googleapiclient import discovery
 
 
 class Site:
-    def __init__(self):
+    # In a worker (see shard.py) the instance is only used for crawling, so
+    # the calendar client and the saved data are not needed
+    def __init__(self, settings_file='settings.ini', worker=False):
+        self.settings_file = settings_file
+        self.worker = worker
+        self.calendar_client = None
+        self.coordinator = None
+        self.logged_in_as = None
+        self.data_file = None
+        self.calendar_file = None
+        self._read_settings()
+
+        # Login into MCA
+        self._login()
+
+    # The whole file is parsed before any attribute is assigned, so that an
+    # invalid value leaves the current settings untouched and the file is
+    # read again on the next reload_if_changed
+    def _read_settings(self):
+        mtime = os.path.getmtime(self.settings_file)
         config = configparser.ConfigParser()
-        config.read('settings.ini')
+        config.read(self.settings_file)
         settings = config['Settings']
-        self.email = settings['Email']
-        self.center = settings['Center']
-        self.password = settings['Password']
-        self.data_file = settings['DataFile']
-        self.calendar_file = settings['CalendarFile']
-        self.activities = settings['Activities'].split(',')
-        self.level = int(settings['Level'])
-        self.sleep = int(settings['Sleep'])
-        self.log_enabled = settings['Log'] == 'True'
-        self.calendar_id = settings['CalendarId']
+        values = {
+            'email': settings['Email'],
+            'center': settings['Center'],
+            'password': settings['Password'],
+            'data_file': settings['DataFile'],
+            'calendar_file': settings['CalendarFile'],
+            'health_file': settings.get('HealthFile', ''),
+            'activities': settings['Activities'].split(','),
+            'level': int(settings['Level']),
+            'sleep': int(settings['Sleep']),
+            'log_enabled': settings['Log'] == 'True',
+            'stream': settings.get('Stream', 'False') == 'True',
+            'workers': int(settings.get('Workers', '1')),
+            'unit_timeout': int(settings.get('UnitTimeout', '120')),
+            'calendar_id': settings['CalendarId'],
+            # Initialize Pushover client
+            'pushover_client': Client(
+                settings['PushoverUserKey'],
+                api_token=settings['PushoverApiToken']
+            ),
+        }
+
+        # Read existing data and calendar events, again if the files changed
+        if not self.worker:
+            if values['data_file'] != self.data_file:
+                with open(values['data_file'], 'r') as f:
+                    values['data'] = json.load(f)
+            if values['calendar_file'] != self.calendar_file:
+                with open(values['calendar_file'], 'r') as f:
+                    values['calendar_data'] = json.load(f)
+
+        for name, value in values.items():
+            setattr(self, name, value)
+        self.settings_mtime = mtime
 
         # Initialize Google Calendar client
-        if self.calendar_id:
+        if self.calendar_id and self.calendar_client is None and not self.worker:
             self._initialize_calendar_client()
 
-        # Initialize Pushover client
-        self.pushover_client = Client(
-            settings['PushoverUserKey'],
-            api_token=settings['PushoverApiToken']
-        )
-
-        # Read existing data and calendar events
-        with open(self.data_file, 'r') as f:
-            self.data = json.load(f)
-        with open(self.calendar_file, 'r') as f:
-            self.calendar_data = json.load(f)
-
-        # Login into MCA
-        self._login()
+    # Re-read settings.ini if it was modified since the last read. Activities,
+    # level, sleep etc. are picked up as is, the MCA session is only renewed
+    # when the credentials or the center differ from the last successful
+    # login (which also retries a login that failed after a previous reload).
+    def reload_if_changed(self):
+        reloaded = False
+        if os.path.getmtime(self.settings_file) != self.settings_mtime:
+            self._read_settings()
+            print(f'Reloaded {self.settings_file}, activities: {self.activities}')
+            # Workers have their own copy of the settings, start new ones
+            self.close()
+            reloaded = True
+        if (self.email, self.password, self.center) != self.logged_in_as:
+            self._login()
+        return reloaded
+
+    def close(self):
+        if self.coordinator is not None:
+            self.coordinator.close()
+            self.coordinator = None
 
     def _initialize_calendar_client(self):
         flow = client.flow_from_clientsecrets(
@@ -87,54 +143,77 @@ class Site:
             json_all[activity] = json_activity
         return json_all
 
-    def _get_all_flat(self):
-        flat = list()
+    # Work units (activity, period id, period, tarif id, tarif), i.e. all
+    # creneaux pages to be crawled
+    def _get_work_units(self):
         for activity in self.activities:
             all_periods = self._get_periods(activity)
             for period in all_periods:
                 all_tarifs = self._get_tarifs(activity, self.level, period)
                 for tarif in all_tarifs:
-                    all_slots = self._get_availabilities(self.level, period, tarif)
-                    for slot in all_slots:
-                        s = all_slots[slot]
-                        flat.append({
-                            "period": all_periods[period],
-                            "period_id": period,
-                            "tarif": all_tarifs[tarif].replace('&eacute;', 'é'),
-                            "tarif_id": tarif,
-                            "activity": activity,
-                            "slot_id": slot,
-                            "date": s['date'],
-                            "time": s['time'],
-                            "duration": s['duration'],
-                            "capacity": s['capacity'],
-                        })
+                    yield activity, period, all_periods[period], tarif, all_tarifs[tarif]
+
+    def _get_unit_flat(self, activity, period, period_name, tarif, tarif_name):
+        flat = list()
+        for slot, s in self._iter_availabilities(self.level, period, tarif):
+            flat.append({
+                "period": period_name,
+                "period_id": period,
+                "tarif": tarif_name.replace('&eacute;', 'é'),
+                "tarif_id": tarif,
+                "activity": activity,
+                "slot_id": slot,
+                "date": s['date'],
+                "time": s['time'],
+                "duration": s['duration'],
+                "capacity": s['capacity'],
+            })
         return flat
 
-    def _get_all_events_flat(self):
+    def _get_all_flat(self):
+        if self.workers > 1:
+            if self.coordinator is None:
+                self.coordinator = Coordinator(self.settings_file, self.workers, self.unit_timeout)
+            return self.coordinator.crawl(self._get_work_units())
+
         flat = list()
+        for unit in self._get_work_units():
+            flat.extend(self._get_unit_flat(*unit))
+        return flat
+
+    def _get_all_events_flat(self):
+        if self.stream:
+            with self._send_get(f'espace-perso/reservations/', stream=True) as reservations:
+                self._log(reservations, f"Getting list of reservations")
+                return list(self._parse_reservations(iter_fragments(
+                    self._iter_text(reservations),
+                    lambda tag, attrs, parent: tag == 'tr' and parent == 'table'
+                )))
 
         reservations = self._send_get(f'espace-perso/reservations/')
         self._log(reservations, f"Getting list of reservations")
         soup = BeautifulSoup(reservations.text, 'html.parser')
-
-        for table in soup.find_all('table'):
-            for tr in list(table.children):
-                if tr.name == 'tr':
-                    l = list(tr.children)
-                    if len(l) == 5:
-                        if list(l[1].children)[0].strip() == 'Activité:':
-                            descr = list(l[3].children)[0].strip()
-                            # Aquabiking Noir le vendredi 29/07/2022 de 18h15 à 19h00 (45 minutes)
-                            m = re.search("(.+) le .+ (\\d+)/(\\d+)/(\\d+) de (\\d+)h(\\d+) à (\\d+)h(\\d+) .+", descr)
-                            if m is not None:
-                                flat.append({
-                                    'event_type': m.group(1),
-                                    'event_date': f'{m.group(4)}-{m.group(3)}-{m.group(2)}',
-                                    'event_from': f'{m.group(5)}:{m.group(6)}',
-                                    'event_to': f'{m.group(7)}:{m.group(8)}',
-                                })
-        return flat
+        return list(self._parse_reservations(
+            tr for table in soup.find_all('table') for tr in table.children
+        ))
+
+    @staticmethod
+    def _parse_reservations(trs):
+        for tr in trs:
+            if tr.name == 'tr':
+                l = list(tr.children)
+                if len(l) == 5:
+                    if list(l[1].children)[0].strip() == 'Activité:':
+                        descr = list(l[3].children)[0].strip()
+                        # Aquabiking Noir le vendredi 29/07/2022 de 18h15 à 19h00 (45 minutes)
+                        m = re.search("(.+) le .+ (\\d+)/(\\d+)/(\\d+) de (\\d+)h(\\d+) à (\\d+)h(\\d+) .+", descr)
+                        if m is not None:
+                            yield {
+                                'event_type': m.group(1),
+                                'event_date': f'{m.group(4)}-{m.group(3)}-{m.group(2)}',
+                                'event_from': f'{m.group(5)}:{m.group(6)}',
+                                'event_to': f'{m.group(7)}:{m.group(8)}',
+                            }
 
     # Main entry point into this class
     def update(self, save):
@@ -155,7 +234,7 @@ class Site:
 
         return added, added_events
 
-    def _send_get(self, url):
+    def _send_get(self, url, stream=False):
         return self.session.get(
             f'https://moncentreaquatique.com/{url}',
             headers={
@@ -171,76 +250,121 @@ class Site:
                 'Sec-Fetch-User': '?1',
                 'Cache-Control': 'max-age=0',
             },
-            cookies=self.cookies
+            cookies=self.cookies,
+            stream=stream,
+            timeout=self.unit_timeout
         )
 
+    # Decoded body of a streamed response, chunk by chunk
+    def _iter_text(self, res):
+        if res.encoding is None:
+            res.encoding = 'utf-8'
+        return res.iter_content(chunk_size=8192, decode_unicode=True)
+
+    # Lines of the response body, without keeping the whole body in memory in
+    # the streaming mode
+    def _iter_lines(self, res):
+        if self.stream:
+            if res.encoding is None:
+                res.encoding = 'utf-8'
+            return res.iter_lines(decode_unicode=True)
+        return res.text.split('\n')
+
     def _get_periods(self, activity):
         res = dict()
-        act = self._send_get(f'module-inscriptions/activite/?activite={activity}')
-        self._log(act, f"Select activity {activity}")
-        for line in act.text.split('\n'):
-            if line.startswith("<option  value='"):
-                m = re.search("<option  value='(.+)'>(.+)", line)
-                res[m.group(1)] = m.group(2)
+        with self._send_get(f'module-inscriptions/activite/?activite={activity}', stream=self.stream) as act:
+            self._log(act, f"Select activity {activity}")
+            for line in self._iter_lines(act):
+                if line.startswith("<option  value='"):
+                    m = re.search("<option  value='(.+)'>(.+)", line)
+                    res[m.group(1)] = m.group(2)
         print(f'Periods: {res}')
         print()
         return res
 
     def _get_tarifs(self, activity, level, period):
         res = dict()
-        tarifs = self._send_get(f'module-inscriptions/activite/?scroll=content&activite={activity}&niveau={level}&periode={period}')
-        self._log(tarifs, f"Select period {period}")
-        for line in tarifs.text.split('\n'):
-            if line.startswith("<option value='"):
-                m = re.search("<option value='(.+)'>(.+)", line)
-                res[m.group(1)] = m.group(2)
+        with self._send_get(f'module-inscriptions/activite/?scroll=content&activite={activity}&niveau={level}&periode={period}', stream=self.stream) as tarifs:
+            self._log(tarifs, f"Select period {period}")
+            for line in self._iter_lines(tarifs):
+                if line.startswith("<option value='"):
+                    m = re.search("<option value='(.+)'>(.+)", line)
+                    res[m.group(1)] = m.group(2)
         print(f'Tarifs: {res}')
         print()
         return res
 
     def _get_availabilities(self, level, period, tarif):
-        res = dict()
         print(f'URL: module-inscriptions/creneaux/?scroll=content&niveau={level}&periode={period}&tarif={tarif}')
         avail = self._send_get(f'module-inscriptions/creneaux/?scroll=content&niveau={level}&periode={period}&tarif={tarif}')
         self._log(avail, f"Select tarif {tarif}")
 
         soup = BeautifulSoup(avail.text, 'html.parser')
+        res = dict(self._parse_creneaux(soup.find_all('td')))
 
+        print(f'Availabilities: {res}')
+        print()
+        return res
+
+    # Same as _get_availabilities, but in the streaming mode the slots are
+    # yielded while the page is being downloaded and parsed, and only the
+    # current chunk and table cell are held in memory
+    def _iter_availabilities(self, level, period, tarif):
+        if not self.stream:
+            yield from self._get_availabilities(level, period, tarif).items()
+            return
+
+        print(f'URL: module-inscriptions/creneaux/?scroll=content&niveau={level}&periode={period}&tarif={tarif}')
+        with self._send_get(f'module-inscriptions/creneaux/?scroll=content&niveau={level}&periode={period}&tarif={tarif}', stream=True) as avail:
+            self._log(avail, f"Select tarif {tarif}")
+            for slot_id, slot in self._parse_creneaux(iter_fragments(self._iter_text(avail), self._is_creneau_td)):
+                print(f'Availability: {slot_id} {slot}')
+                yield slot_id, slot
+        print()
+
+    DATE_STYLE = 'padding:20px;text-align:left;vertical-align:middle;font-weight:900;font-size:24px;color:#1c5861;padding-right:50px;'
+    SLOT_STYLE = 'padding:20px;text-align:left;vertical-align:middle;padding-right:50px;'
+    TIME_STYLE = 'vertical-align:middle;'
+
+    @staticmethod
+    def _is_creneau_td(tag, attrs, parent):
+        return tag == 'td' and dict(attrs).get('style') in (Site.DATE_STYLE, Site.SLOT_STYLE, Site.TIME_STYLE)
+
+    # Takes the <td> elements of the creneaux page (BeautifulSoup tags or
+    # htmlstream nodes) and yields (slot id, slot) for the available slots
+    @staticmethod
+    def _parse_creneaux(tds):
         last_date = None
         last_time = None
         last_duration = None
         last_capacity = None
         last_id = None
 
-        for td in soup.find_all('td'):
+        for td in tds:
             style = td.get('style', '/')
-            if style == 'padding:20px;text-align:left;vertical-align:middle;font-weight:900;font-size:24px;color:#1c5861;padding-right:50px;':
+            if style == Site.DATE_STYLE:
                 l = list(td.children)
                 last_date = str(l[0]).strip() + ', ' + str(l[2]).strip()
-            elif style == 'padding:20px;text-align:left;vertical-align:middle;padding-right:50px;':
+            elif style == Site.SLOT_STYLE:
                 l = list(td.children)
                 s = list(l[1].children)
                 last_capacity = s[2].strip()
                 if s[1].get('src', '?') == '/module-inscriptions/images/personne_vert.svg':
                     onclick = l[8].get('onclick', '?')
-                    m = re.search('afficher_popup_reserver\((.+?),', onclick)
+                    m = re.search('afficher_popup_reserver\\((.+?),', onclick)
                     last_id = m.group(1)
-                    res[last_id] = {
+                    yield last_id, {
                         "date": last_date,
                         "time": last_time,
                         "duration": last_duration,
                         "capacity": last_capacity,
                     }
-            elif style == 'vertical-align:middle;':
+            elif style == Site.TIME_STYLE:
                 l = list(td.children)
                 last_time = list(l[1].children)[0].replace('\xa0', ' ')
                 s = list(l[5].children)
                 last_duration = s[1].strip()
 
-        print(f'Availabilities: {res}')
-        print()
-        return res
-
     def _activity_to_str(self, a):
         if a == '109':
             return 'Aquabiking Noir'
@@ -258,18 +382,8 @@ class Site:
     def _calculate_diff(self, new):
         old = self.data
         print (f'Calculating diff between {len(old)} and {len(new)}')
-        added = list()
-        for n in new:
-            is_added = True
-            for o in old:
-                if n['period_id'] == o['period_id'] \
-                and n['tarif_id'] == o['tarif_id'] \
-                and n['slot_id'] == o['slot_id']:
-                    is_added = False
-                    break
-            if is_added:
-                added.append(n)
-        return added
+        old_keys = {(o['period_id'], o['tarif_id'], o['slot_id']) for o in old}
+        return [n for n in new if (n['period_id'], n['tarif_id'], n['slot_id']) not in old_keys]
 
     def _calculate_events_diff(self, new):
         old = self.calendar_data
@@ -299,13 +413,21 @@ class Site:
 
     def _save(self, new):
         self.data = new
-        with open(self.data_file, 'w') as f:
-            json.dump(self.data, f, indent=2)
+        self._write_json(self.data_file, self.data)
 
     def _save_calendar(self, new):
         self.calendar_data = new
-        with open(self.calendar_file, 'w') as f:
-            json.dump(self.calendar_data, f, indent=2)
+        self._write_json(self.calendar_file, self.calendar_data)
+
+    # Write to a temporary file first, so that the existing file is never left
+    # truncated if the process dies in the middle of the write
+    def _write_json(self, path, data):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
 
     def _log(self, res, name):
         if self.log_enabled:
@@ -315,36 +437,113 @@ class Site:
             print(f'Headers: {res.headers}')
             print(f'Encoding: {res.encoding}')
             print(f'Cookies: {res.cookies.get_dict()}')
-            print(f'Text: {len(res.text)}')
+            if self.stream:
+                print(f"Content-Length: {res.headers.get('Content-Length', '?')}")
+            else:
+                print(f'Text: {len(res.text)}')
             print()
 
     def _login(self):
         self.session = requests.Session()
         self.cookies = requests.cookies.RequestsCookieJar()
-        self.cookies.set('OKSES', 'o6up7mham4dih0nsahkdf3u1n9', domain='moncentreaquatique.com', path='/')
+        # MCA keeps the selected center, activity and period in the session,
+        # so each Site (e.g. each worker, see shard.py) needs its own one
+        session_id = ''.join(secrets.choice(string.ascii_lowercase + string.digits) for _ in range(26))
+        self.cookies.set('OKSES', session_id, domain='moncentreaquatique.com', path='/')
 
         res = requests.post(
             'https://moncentreaquatique.com/espace-perso/connexion/',
             headers={'User-Agent': 'Mozilla/5.0'},
             data={'email': self.email, 'password': self.password},
-            cookies=self.cookies
+            cookies=self.cookies,
+            timeout=self.unit_timeout
         )
         self._log(res, "Login")
 
         res = self._send_get(f'module-inscriptions/?centre={self.center}')
         self._log(res, "Select center")
-
-
-if __name__ == '__main__':
-    site = Site()
-    while True:
+        self.logged_in_as = (self.email, self.password, self.center)
+
+
+class Daemon:
+    # Seconds between checks of settings.ini while sleeping
+    RELOAD_INTERVAL = 5
+
+    def __init__(self, site):
+        self.site = site
+        self.stopping = threading.Event()
+        self.last_success = None
+        self.last_error = None
+        self.failed_settings_mtime = None
+
+    def _stop(self, signum, frame):
+        print(f'Received signal {signum}, stopping after the current cycle')
+        self.stopping.set()
+
+    # Health file for external monitoring: the daemon is ready once it has
+    # completed at least one cycle, and healthy as long as last_success is
+    # recent enough (compared to the configured Sleep)
+    def _write_health(self):
+        if not self.site.health_file:
+            return
+        # Never let the monitoring file stop the crawler
+        try:
+            self.site._write_json(self.site.health_file, {
+                'pid': os.getpid(),
+                'ready': self.last_success is not None,
+                'last_success': self.last_success,
+                'last_error': self.last_error,
+                'sleep': self.site.sleep,
+            })
+        except OSError as e:
+            print(f'Error writing {self.site.health_file}: {e}')
+
+    # Invalid settings are reported once and the current ones are kept
+    def _reload(self):
         try:
-            d, e = site.update(save=True)
-            print(d)
-            print(e)
+            self.site.reload_if_changed()
         except Exception as e:
-            print(f'Error: {e}')
-            print(traceback.format_exc())            
+            mtime = os.path.getmtime(self.site.settings_file) if os.path.exists(self.site.settings_file) else None
+            if mtime != self.failed_settings_mtime:
+                self.failed_settings_mtime = mtime
+                print(f'Error reloading {self.site.settings_file}: {e}')
+                print(traceback.format_exc())
+                self.last_error = f'{time.strftime("%Y-%m-%dT%H:%M:%S%z")}: {e}'
+
+    # Sleep until the next cycle, checking settings.ini regularly so that
+    # e.g. a shorter Sleep applies right away
+    def _wait(self):
+        started = time.monotonic()
+        while not self.stopping.wait(min(self.RELOAD_INTERVAL, self.site.sleep)):
+            self._reload()
+            if time.monotonic() - started >= self.site.sleep:
+                return
+
+    def run(self):
+        # The handlers only raise a flag: a cycle that is in progress (crawl,
+        # notifications and saving state) is always completed before exiting
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self._write_health()
+
+        while not self.stopping.is_set():
+            self._reload()
+            try:
+                d, e = self.site.update(save=True)
+                print(d)
+                print(e)
+                self.last_success = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+            except Exception as e:
+                print(f'Error: {e}')
+                print(traceback.format_exc())
+                self.last_error = f'{time.strftime("%Y-%m-%dT%H:%M:%S%z")}: {e}'
+
+            self._write_health()
+            self._wait()
+
+        self.site.close()
+        print('Stopped')
 
-        time.sleep(site.sleep)
 
+if __name__ == '__main__':
+    Daemon(Site()).run()
@@ -0,0 +1,160 @@
+"""Peak memory allocated while parsing a creneaux page, with BeautifulSoup on
+the whole body versus the streaming parser fed chunk by chunk. Before that,
+checks that both parsers extract the same slots and reservations, including
+from malformed pages and with chunks cut anywhere.
+
+The pages are generated locally to look like the MCA ones, so no account nor
+network access is needed:
+
+    python bench_memory.py [slots per page ...]
+"""
+import sys
+import tracemalloc
+from bs4 import BeautifulSoup
+from api import Site
+from htmlstream import iter_fragments
+
+CHUNK_SIZE = 8192
+
+
+def _day(i):
+    return (
+        f'<tr><td style="{Site.DATE_STYLE}">\n'
+        f'Jour {i}<br>\n{i % 28 + 1:02}/09/2022\n'
+        f'</td></tr>\n'
+    )
+
+
+def _slot(i):
+    return (
+        f'<tr><td style="{Site.TIME_STYLE}">\n'
+        f'<span>18h{i % 60:02}\xa0-\xa019h00</span>\n<br>\n'
+        f'<span><img src="/module-inscriptions/images/horloge.svg">45 minutes</span>\n'
+        f'</td>\n'
+        f'<td style="{Site.SLOT_STYLE}">\n'
+        f'<div><img src="/module-inscriptions/images/personne.svg">'
+        f'<img src="/module-inscriptions/images/personne_vert.svg"> {i % 12} places</div>\n'
+        f'<br>\n<br>\n<br>'
+        f'<button onclick="afficher_popup_reserver({100000 + i}, 1);">Réserver</button>\n'
+        f'</td></tr>\n'
+    )
+
+
+# Yields the page piece by piece, like a streamed response would
+def _iter_page(slots):
+    yield '<html><body><table>\n'
+    for i in range(slots):
+        if i % 10 == 0:
+            yield _day(i // 10)
+        yield _slot(i)
+    yield '</table></body></html>\n'
+
+
+def _iter_chunks(slots, chunk_size=CHUNK_SIZE):
+    buf = ''
+    for piece in _iter_page(slots):
+        buf += piece
+        while len(buf) >= chunk_size:
+            yield buf[:chunk_size]
+            buf = buf[chunk_size:]
+    yield buf
+
+
+def _reservation(name):
+    return (
+        f'<tr>\n<td>Activité:</td>\n'
+        f'<td>{name} le vendredi 29/07/2022 de 18h15 à 19h00 (45 minutes)</td>\n'
+    )
+
+
+RESERVATION_PAGES = [
+    '<table>\n' + _reservation('A') + '</tr>\n</table>\n<table>\n' + _reservation('B') + '</tr>\n</table>',
+    # Unclosed row, closed by the end of its table
+    '<table>\n' + _reservation('A') + '</table>\n<table>\n' + _reservation('B') + '</tr>\n</table>',
+    # Unclosed row and table at the end of the page
+    '<table>\n' + _reservation('A') + '</tr>\n' + _reservation('B'),
+    # Nested rows, none of them is a reservation for BeautifulSoup
+    '<table>\n' + _reservation('A') + _reservation('B') + '</tr>\n</table>',
+    '<table><!-- comment -->\n' + _reservation('A') + '</tr>\n<tr><td>Total</td></tr>\n</table>',
+    # Reservation in a layout table
+    '<table><tr><td><table>' + _reservation('A') + '</tr></table></td></tr></table>',
+]
+
+
+# A creneaux cell nested in another one (the date in the layout of a time)
+def _nested_page():
+    day = _day(0)
+    day = day[day.index('<td'):day.rindex('</td>') + 5]
+    slot = _slot(0)
+    time_end = slot.index('</td>')
+    return (
+        '<table>\n' + slot[:time_end]
+        + f'<table><tr>{day}</tr></table>'
+        + slot[time_end:] + '</table>\n'
+    )
+
+
+def _split(text, chunk_size):
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+def check():
+    for chunk_size in (1, 7, CHUNK_SIZE):
+        soup = list(Site._parse_creneaux(
+            BeautifulSoup(''.join(_iter_page(25)), 'html.parser').find_all('td')
+        ))
+        stream = list(Site._parse_creneaux(
+            iter_fragments(_iter_chunks(25, chunk_size), Site._is_creneau_td)
+        ))
+        assert len(soup) == 25 and soup == stream, f'creneaux differ with chunks of {chunk_size}'
+
+        page = _nested_page()
+        soup = list(Site._parse_creneaux(BeautifulSoup(page, 'html.parser').find_all('td')))
+        stream = list(Site._parse_creneaux(iter_fragments(_split(page, chunk_size), Site._is_creneau_td)))
+        assert soup[0][1]['date'] and soup == stream, f'nested creneaux differ with chunks of {chunk_size}: {soup} != {stream}'
+
+        for page in RESERVATION_PAGES:
+            soup = list(Site._parse_reservations(
+                tr for table in BeautifulSoup(page, 'html.parser').find_all('table') for tr in table.children
+            ))
+            stream = list(Site._parse_reservations(iter_fragments(
+                _split(page, chunk_size),
+                lambda tag, attrs, parent: tag == 'tr' and parent == 'table'
+            )))
+            assert soup == stream, f'reservations differ with chunks of {chunk_size}: {soup} != {stream}\n{page}'
+    print('Streaming and BeautifulSoup parsers agree')
+
+
+def _parse_soup(slots):
+    text = ''.join(_iter_page(slots))
+    soup = BeautifulSoup(text, 'html.parser')
+    return sum(1 for _ in Site._parse_creneaux(soup.find_all('td')))
+
+
+def _parse_stream(slots):
+    fragments = iter_fragments(_iter_chunks(slots), Site._is_creneau_td)
+    return sum(1 for _ in Site._parse_creneaux(fragments))
+
+
+def _measure(parse, slots):
+    tracemalloc.start()
+    count = parse(slots)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert count == slots, f'{parse.__name__} found {count} slots out of {slots}'
+    return peak
+
+
+def main():
+    check()
+    sizes = [int(a) for a in sys.argv[1:]] or [100, 1000, 10000]
+    print(f'{"slots":>8} {"page KiB":>10} {"soup KiB":>10} {"stream KiB":>11}')
+    for slots in sizes:
+        size = sum(len(p.encode()) for p in _iter_page(slots))
+        soup = _measure(_parse_soup, slots)
+        stream = _measure(_parse_stream, slots)
+        print(f'{slots:>8} {size // 1024:>10} {soup // 1024:>10} {stream // 1024:>11}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+from html.parser import HTMLParser
+
+# Elements that never have content nor a closing tag
+VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+}
+
+
+class Comment(str):
+    pass
+
+
+class Node:
+    """Minimal element node, exposing the same ``name``, ``children`` and
+    ``get`` as BeautifulSoup's ``Tag``, so that the same code can extract data
+    from either of them. Text children are plain strings, adjacent text is
+    merged like BeautifulSoup does.
+    """
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = {k: v if v is not None else '' for k, v in attrs}
+        self.children = []
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def append_text(self, data):
+        if self.children and type(self.children[-1]) is str:
+            self.children[-1] += data
+        else:
+            self.children.append(data)
+
+
+class FragmentParser(HTMLParser):
+    """Incremental HTML parser which only builds the subtrees of the elements
+    accepted by ``predicate(tag, attrs, parent)``, and discards everything
+    else as soon as it is parsed. ``parent`` is the name of the enclosing
+    element. The complete subtrees are accumulated in ``fragments``, which is
+    meant to be drained by the caller after every ``feed``.
+
+    Like BeautifulSoup's ``find_all``, matching elements nested in another
+    one are returned as well, after their ancestor (in the order of their
+    start tags), once the outermost one is complete.
+    """
+
+    def __init__(self, predicate):
+        super().__init__()
+        self.predicate = predicate
+        self.fragments = []
+        self._open = []      # names of the open elements outside of a fragment
+        self._stack = []     # open nodes of the current fragment
+        self._matched = []   # matching nodes of the current fragment
+
+    def handle_starttag(self, tag, attrs):
+        if self._stack:
+            node = Node(tag, attrs)
+            if self.predicate(tag, attrs, self._stack[-1].name):
+                self._matched.append(node)
+            self._stack[-1].children.append(node)
+            if tag not in VOID_ELEMENTS:
+                self._stack.append(node)
+        elif self.predicate(tag, attrs, self._open[-1] if self._open else None):
+            node = Node(tag, attrs)
+            self._matched.append(node)
+            if tag in VOID_ELEMENTS:
+                self._flush()
+            else:
+                self._stack.append(node)
+        elif tag not in VOID_ELEMENTS:
+            self._open.append(tag)
+
+    def handle_endtag(self, tag):
+        if self._stack:
+            if tag in (n.name for n in self._stack):
+                while True:
+                    node = self._stack.pop()
+                    if node.name == tag:
+                        break
+                if not self._stack:
+                    self._flush()
+                return
+            if tag not in self._open:
+                return
+            # The end tag of an enclosing element (e.g. </table> after an
+            # unclosed <tr>) implicitly closes the current fragment
+            self._flush()
+        if tag in self._open:
+            while self._open.pop() != tag:
+                pass
+
+    def handle_data(self, data):
+        if self._stack:
+            self._stack[-1].append_text(data)
+
+    def handle_comment(self, data):
+        if self._stack:
+            self._stack[-1].children.append(Comment(data))
+
+    def close(self):
+        super().close()
+        # Elements left open at the end of the document are complete as well
+        self._flush()
+
+    def _flush(self):
+        self.fragments.extend(self._matched)
+        self._matched.clear()
+        self._stack.clear()
+
+
+def iter_fragments(chunks, predicate):
+    """Feed the text ``chunks`` to a :class:`FragmentParser` and yield the
+    matching subtrees as soon as they are complete. Only the current chunk and
+    the current fragment are held in memory.
+    """
+    parser = FragmentParser(predicate)
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.fragments
+        parser.fragments.clear()
+    parser.close()
+    yield from parser.fragments
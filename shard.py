@@ -0,0 +1,162 @@
+import math
+import signal
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# Number of times a work unit is dispatched before giving up on the cycle
+MAX_ATTEMPTS = 3
+
+# Worker process state: its own Site, logged into MCA with its own session,
+# and the (activity, period) currently selected in that session
+_site = None
+_selected = None
+
+
+def _init_worker(settings_file):
+    global _site
+    # The coordinator decides when the workers stop, so that a Ctrl-C or a
+    # SIGTERM lets it finish the current cycle
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    from api import Site
+    _site = Site(settings_file, worker=True)
+
+
+# MCA sessions are stateful: the activity and the period must be selected
+# before the creneaux page of a tarif can be requested
+def _select(activity, period):
+    global _selected
+    if _selected != (activity, period):
+        _site._get_periods(activity)
+        _site._get_tarifs(activity, _site.level, period)
+        _selected = (activity, period)
+
+
+def _crawl_unit(unit):
+    global _selected
+    activity, period = unit[0], unit[1]
+    try:
+        _select(activity, period)
+        return _site._get_unit_flat(*unit)
+    except Exception as e:
+        # Most likely the session has expired, log in again and retry once,
+        # if it fails again the coordinator sends the unit to another worker
+        print(f'Worker error on {unit}: {e}')
+        print(traceback.format_exc())
+        _selected = None
+        _site._login()
+        _select(activity, period)
+        return _site._get_unit_flat(*unit)
+
+
+class Coordinator:
+    """Distributes the work units of a cycle over a pool of worker processes,
+    each one with its own MCA session, and merges their results in the order
+    of the units, as if they were crawled sequentially.
+
+    At most one unit per worker is in flight, the next one is submitted when
+    a worker is done, so a slow worker simply takes fewer of them. A unit
+    which fails, or takes longer than ``unit_timeout`` seconds, is retried
+    up to ``MAX_ATTEMPTS`` times. A stuck worker is killed by restarting the
+    whole pool, and so is a pool in which a worker process died. The cycle
+    fails if a unit is given up on or if the cycle exceeds its deadline.
+    """
+
+    def __init__(self, settings_file, workers, unit_timeout):
+        self.settings_file = settings_file
+        self.workers = workers
+        self.unit_timeout = unit_timeout
+        self.pool = None
+
+    def _start(self):
+        self.pool = ProcessPoolExecutor(
+            self.workers,
+            initializer=_init_worker,
+            initargs=(self.settings_file,)
+        )
+
+    def close(self):
+        if self.pool is not None:
+            # Stuck workers never exit by themselves, and would also block
+            # the exit of the interpreter, so they are killed
+            for p in list((self.pool._processes or {}).values()):
+                p.terminate()
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def crawl(self, units):
+        units = list(units)
+        print(f'Crawling {len(units)} units with {self.workers} workers')
+        try:
+            return self._crawl(units)
+        except Exception:
+            # Don't leave units of a failed cycle running into the next one
+            self.close()
+            raise
+
+    def _crawl(self, units):
+        results = dict()
+        attempts = [0] * len(units)
+        todo = deque(range(len(units)))
+        running = dict()
+        # Enough for every worker to crawl its share, plus a few timeouts
+        cycle_timeout = self.unit_timeout * (math.ceil(len(units) / self.workers) + MAX_ATTEMPTS)
+        deadline = time.monotonic() + cycle_timeout
+
+        while len(results) < len(units):
+            if time.monotonic() > deadline:
+                raise Exception(f'Crawling {len(units)} units took more than {cycle_timeout}s')
+            if self.pool is None:
+                self._start()
+            while todo and len(running) < self.workers:
+                i = todo.popleft()
+                attempts[i] += 1
+                running[self.pool.submit(_crawl_unit, units[i])] = (i, time.monotonic())
+
+            # Wake up when the oldest unit in flight times out at the latest
+            oldest = min(started for _, started in running.values())
+            timeout = min(oldest + self.unit_timeout, deadline) - time.monotonic()
+            done, _ = wait(running, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            for f in done:
+                i, _ = running.pop(f)
+                try:
+                    results[i] = f.result()
+                except BrokenProcessPool:
+                    if self.pool is not None:
+                        print(f'A worker died while crawling {units[i]}, restarting the pool')
+                        self.close()
+                    self._retry(units, i, attempts, todo)
+                except Exception as e:
+                    print(f'Failed to crawl {units[i]}: {e}')
+                    self._retry(units, i, attempts, todo)
+
+            now = time.monotonic()
+            slow = [i for i, started in running.values() if now - started >= self.unit_timeout]
+            if slow:
+                print(f'Crawling {[units[i] for i in slow]} takes too long, restarting the pool')
+                self.close()
+
+            # The units in flight in a killed or broken pool are dispatched
+            # again, only the slow ones count as failed
+            if self.pool is None:
+                for i, _ in running.values():
+                    if i in slow:
+                        self._retry(units, i, attempts, todo)
+                    elif i not in todo:
+                        attempts[i] -= 1
+                        todo.append(i)
+                running.clear()
+
+        flat = list()
+        for i in range(len(units)):
+            flat.extend(results[i])
+        return flat
+
+    def _retry(self, units, i, attempts, todo):
+        if attempts[i] >= MAX_ATTEMPTS:
+            raise Exception(f'Giving up on {units[i]} after {attempts[i]} attempts')
+        if i not in todo:
+            todo.append(i)